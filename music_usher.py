@@ -13,21 +13,48 @@ audio files.
 
 NOTE: Module organises mp3 and ogg files only.
 '''
+import errno
 import logging
 import re
 import os
 import shutil
+import sys
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3NoHeaderError
+from mutagen.id3 import Frames, Frames_2_2, ID3NoHeaderError
 
 
 LOGGER = logging.getLogger(__name__)
 
-MEDIA_FILES_REGEX = re.compile(r'.*\.(mp3|ogg)$', re.IGNORECASE)
+MEDIA_EXTS = ('.mp3', '.ogg')     # Lower case extensions of files to organise
 
 DRY_RUN = False
 MOVE_EXPORT = False     # Move files in export else just copy them
+EXPORT_WORKERS = 1      # Number of files Library.export copies/moves at once
+
+COPY_BUFSIZE = 4 * 1024 * 1024    # Chunk size used by fast_copy
+
+# shutil.copyfile only copies in kernel space since Python 3.8, and
+# then only on Linux (sendfile) and macOS (fcopyfile)
+SHUTIL_ZERO_COPY = (sys.version_info >= (3, 8)
+                    and sys.platform in ('linux', 'darwin'))
+
+TRACK_TOTAL_REGEX = re.compile(r'/\d+$')   # eg the /12 in tracknumber 3/12
+
+# Read when loading library, covers everything organising and naming needs
+LOAD_FIELDS = ('albumartist', 'artist', 'album', 'title', 'tracknumber')
+
+# ID3 frames behind the EasyID3 keys we read selectively, as named in
+# ID3v2.3/v2.4 and in ID3v2.2 (eg written by older iTunes)
+ID3_FRAMES = {
+    'album': ('TALB', 'TAL'),
+    'albumartist': ('TPE2', 'TP2'),
+    'artist': ('TPE1', 'TP1'),
+    'title': ('TIT2', 'TT2'),
+    'tracknumber': ('TRCK', 'TRK'),
+}
 
 
 def normalise_filename(filename):
@@ -40,7 +67,150 @@ def normalise_filename(filename):
     '''
     return re.sub(r'[\\/<>:"|?*]', ' - ', filename).strip()
 
+
+def make_dirs(path, created=None):
+    '''Creates directory path (and its parents) if not already created.
+
+    `created` is an optional set of directories already made. Path is
+    added to it once created thus asking for the same directory again
+    doesn't touch the file system. Nothing is recorded under DRY_RUN.
+    '''
+    if created is not None and path in created:
+        return
+    LOGGER.debug('Creating directory: %s', path)
+    if DRY_RUN:
+        return
+    os.makedirs(path, exist_ok=True)
+    if created is not None: created.add(path)
+
+
+def fast_copy(src, dst, bufsize=COPY_BUFSIZE):
+    '''Copies contents of file src to dst in chunks of bufsize.
+
+    Only used where shutil.copyfile isn't zero-copy (see
+    SHUTIL_ZERO_COPY). On Linux, ie with Python < 3.8, data is kept in
+    kernel space with os.sendfile; everywhere else (and if sendfile
+    turns out unsupported) it falls back to a plain read/write loop.
+    '''
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        # Only Linux can sendfile to a regular file
+        if sys.platform.startswith('linux'):
+            infd, outfd = src_file.fileno(), dst_file.fileno()
+            try:
+                while os.sendfile(outfd, infd, None, bufsize):
+                    pass
+                return
+            except OSError:
+                if os.lseek(outfd, 0, os.SEEK_CUR):
+                    raise   # Failed half way through not just unsupported
+        shutil.copyfileobj(src_file, dst_file, bufsize)
+
+
+def copy_file(src, dst):
+    '''Copies contents of file src to dst using the fastest means available.'''
+
+    if SHUTIL_ZERO_COPY:
+        shutil.copyfile(src, dst)
+    else:
+        fast_copy(src, dst)
+
+
+def move_file(src, dst):
+    '''Moves file src to dst, replacing dst if it exists.
+
+    The move is left to the OS: MoveFileExW on Windows (which copies
+    across volumes itself) and rename(2) elsewhere, falling back to
+    a copy and delete when src and dst are on different file systems.
+    '''
+    if os.name == 'nt':
+        import ctypes
+
+        # MOVEFILE_REPLACE_EXISTING | MOVEFILE_COPY_ALLOWED
+        # | MOVEFILE_WRITE_THROUGH
+        flags = 0x1 | 0x2 | 0x8
+        if not ctypes.windll.kernel32.MoveFileExW(ctypes.c_wchar_p(src),
+                                                  ctypes.c_wchar_p(dst),
+                                                  flags):
+            raise ctypes.WinError()
+        return
+
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file(src, dst)
+        os.unlink(src)
+
+
+def export_file(src, dst):
+    '''Moves or copies (see MOVE_EXPORT) file src to dst.'''
+
+    # Called once per track, skip building log calls unless needed
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug('%s %s to %s', 'Moving' if MOVE_EXPORT else 'Copying',
+                     src, dst)
+    if DRY_RUN:
+        return
+    if MOVE_EXPORT:
+        move_file(src, dst)
+    else:
+        copy_file(src, dst)
+
+
+def _export_file(plan_item):
+    return export_file(*plan_item)
+
+
+def _iter_media(root):
+    '''Recursively yields os.DirEntry objects for media files under root.
+
+    Uses os.scandir so that file types come from the directory listing
+    itself; no extra stat() call is made per entry. On POSIX systems
+    entries are visited in inode order, which roughly follows their
+    layout on disk and so cuts down on seeking when the cache is cold.
+
+    Directories that can't be read are skipped (as os.walk does).
+    '''
+    LOGGER.debug('Loading media files in sub directory: %s', root)
+    try:
+        with os.scandir(root) as entries:
+            entries = list(entries)
+    except OSError as e:
+        LOGGER.warning('Skipping unreadable directory %s: %s', root, e)
+        return
+    if os.name == 'posix':
+        entries.sort(key=lambda entry: entry.inode())  # inode is from readdir
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from _iter_media(entry.path)
+        elif entry.is_file() and entry.name.lower().endswith(MEDIA_EXTS):
+            yield entry
+
+
+def _read_metadata(path):
+    '''Read the ID3 tag of the file at path into a plain dict.
+
+    The dict maps EasyID3 keys (eg artist) to lists of values. Being
+    plain builtins it can be shipped back from a worker process.
+    '''
+    try:
+        return dict(EasyID3(path))
+    except ID3NoHeaderError:
+        LOGGER.exception('File %s has no ID3 tag', path)
+        return _untagged_metadata(path)
+
+
+def _untagged_metadata(path):
+    '''Metadata for a file without an ID3 tag: just a title off its name.'''
+
+    trunk, _ext = os.path.splitext(path)
+    return {'title': [os.path.basename(trunk)]}
+
+
 class Library:
+    __slots__ = ('path', 'discographies')
 
     def __init__(self, path, autoload=True):
         LOGGER.debug('Initialising library: %s', path)
@@ -50,16 +220,22 @@ class Library:
 
     def load(self):
         LOGGER.debug('Loading files from %s', self.path)
-        for parent_dir, _dirs, files in os.walk(self.path):
-            LOGGER.debug('Loading media files in sub directory: %s', parent_dir)
-            files = filter(lambda f: MEDIA_FILES_REGEX.match(f), files)
-            for file_ in files:
-                track = Track(os.path.join(parent_dir, file_))
-                track_artist = track.get_artist()
-                track_album = track.get_album()
-                discography = self.get_discography(track_artist, create=True)
-                album = discography.get_album(track_album, create=True)
-                album.add(track)
+        paths = [entry.path for entry in _iter_media(self.path)]
+        # Tag parsing is CPU bound (mutagen is pure python), so spread
+        # it across processes and only build up the library here.
+        # NOTE: Workers get full paths rather than names relative to an
+        # open directory fd (as os.fwalk would give) since file
+        # descriptors can't be sent to other processes.
+        with ProcessPoolExecutor() as executor:
+            tags = executor.map(Track.read_tag_fields, paths, chunksize=64)
+            tracks = [Track(path, tags_) for path, tags_ in zip(paths, tags)]
+
+        for track in tracks:
+            track_artist = track.get_artist()
+            track_album = track.get_album()
+            discography = self.get_discography(track_artist, create=True)
+            album = discography.get_album(track_album, create=True)
+            album.add(track, track_artist)
 
     def export(self, path):
         '''Write library to specified directory.
@@ -73,18 +249,38 @@ class Library:
             Track Number. Track Name (1)
         '''
         LOGGER.debug('Exporting library to %s', path)
-        if not os.path.isdir(path):
-            LOGGER.debug('Creating library directory: %s')
-            if not DRY_RUN: os.makedirs(path)
+        plan = self.plan_export(path)
+        if EXPORT_WORKERS > 1:
+            # Copying is I/O bound and releases the GIL so threads suffice
+            with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+                list(executor.map(_export_file, plan))
+        else:
+            for src, dst in plan:
+                export_file(src, dst)
+
+    def plan_export(self, path):
+        '''Returns a list of (source, destination) pairs for exporting to path.
 
+        The directories the destinations go into are created (see
+        make_dirs) as the plan is built. See `export`.
+        '''
+        created = set()     # Directories made for this plan
+        used_names = {}     # Filenames planned so far in each directory
+        make_dirs(path, created)
+        plan = []
         for discography in self:
-            discography.export(path)
+            plan.extend(discography.plan_export(path, created, used_names))
+        return plan
 
     def get_discography(self, artist, create=False):
-        if artist not in self.discographies and create:
+        try:
+            return self.discographies[artist]
+        except KeyError:
+            if not create:
+                return None
             LOGGER.debug('Creating discography: %s', artist)
             self.discographies[artist] = Discography(artist)
-        return self.discographies.get(artist, None)
+            return self.discographies[artist]
 
     def __iter__(self):
         return iter(self.discographies.values())
@@ -93,10 +289,11 @@ class Library:
 class Discography:
     '''Collection of Albums by the same Artist.'''
 
+    __slots__ = ('albums', 'artist')
+
     def __init__(self, artist):
-        LOGGER.debug('Initialising discography: %s', artist)
         self.albums = dict()
-        self.artist = artist
+        self.artist = sys.intern(artist)
 
     def get_album(self, album, create=False):
         '''Retrieve an album from this Discography.
@@ -105,10 +302,14 @@ class Discography:
         and added to this Discography if not found,
         otherwise None is returned if album is not found.
         '''
-        if album not in self.albums and create:
+        try:
+            return self.albums[album]
+        except KeyError:
+            if not create:
+                return None
             LOGGER.debug('Creating album: %s - %s', self.artist, album)
             self.albums[album] = Album(self.artist, album)
-        return self.albums.get(album, None)
+            return self.albums[album]
 
     def export(self, path):
         '''Write Discography to given path.
@@ -121,13 +322,21 @@ class Discography:
         Where Artist is the name of this discography.
         '''
         LOGGER.debug('Exporting %s to %s', self, path)
-        export_path = os.path.join(path, normalise_filename(self.artist))
-        if not os.path.isdir(export_path):
-            LOGGER.debug('Creating discography directory: %s', export_path)
-            if not DRY_RUN: os.makedirs(export_path)
+        for src, dst in self.plan_export(path):
+            export_file(src, dst)
+
+    def plan_export(self, path, created=None, used_names=None):
+        '''Returns (source, destination) pairs for exporting to path.
 
+        `created` and `used_names` are passed on to `Album.plan_export`.
+        '''
+        export_path = os.path.join(path, normalise_filename(self.artist))
+        if used_names is None:
+            used_names = {}
+        plan = []
         for album in self:
-            album.export(export_path)
+            plan.extend(album.plan_export(export_path, created, used_names))
+        return plan
 
     def __iter__(self):
         return iter(self.albums.values())
@@ -137,32 +346,64 @@ class Discography:
 
 
 class Album:
+    __slots__ = ('tracks', 'artist', 'name')
+
     def __init__(self, artist, name):
-        LOGGER.debug('Initialising album: %s - %s', artist, name)
-        self.tracks = set()
-        self.artist = artist
-        self.name = name
+        self.tracks = []
+        self.artist = sys.intern(artist)
+        self.name = sys.intern(name)
 
-    def add(self, track):
-        '''Add a track to this discography.'''
+    def add(self, track, track_artist=None):
+        '''Add a track to this discography.
 
-        track_artist = track.get_artist()
+        `track_artist` may be passed in if already known to save
+        looking it up again on the track.
+        '''
+        if track_artist is None:
+            track_artist = track.get_artist()
         if track_artist != self.artist:
             LOGGER.warn('Track artist (%s) does not match album artist (%s): ',
                         track_artist, self.artist)
-        self.tracks.add(track)
+        self.tracks.append(track)
 
     def export(self, path):
         '''Export album to given path.'''
 
         LOGGER.debug('Exporting %s to %s', self, path)
-        export_path = os.path.join(path, normalise_filename(self.name))
-        if not os.path.isdir(export_path):
-            LOGGER.debug('Creating album directory: %s', export_path)
-            if not DRY_RUN: os.makedirs(export_path)
+        for src, dst in self.plan_export(path):
+            export_file(src, dst)
+
+    def plan_export(self, path, created=None, used_names=None):
+        '''Returns (source, destination) pairs for exporting to path.
+
+        The album's directory is created under path (`created` is
+        passed on to make_dirs). Tracks whose filenames clash have a
+        number appended to them as in:
 
+            Track Number. Track Name (1)
+
+        `used_names` maps each directory to the filenames already
+        planned for it; share it between albums that may end up in the
+        same directory (eg 'AC/DC' and 'AC - DC'). Files already in the
+        target directory are not checked.
+        '''
+        export_path = os.path.join(path, normalise_filename(self.name))
+        make_dirs(export_path, created)
+        if used_names is None:
+            used_names = {}
+        # Lower cased as some file systems ignore case
+        used = used_names.setdefault(export_path.lower(), set())
+        plan = []
         for track in self:
-            track.export(export_path)
+            filename = track.get_filename()
+            trunk, ext = os.path.splitext(filename)
+            count = 0
+            while filename.lower() in used:
+                count += 1
+                filename = f'{trunk} ({count}){ext}'
+            used.add(filename.lower())
+            plan.append((track.path, os.path.join(export_path, filename)))
+        return plan
 
     def __str__(self):
         return 'Album(/{0}/{1})'.format(self.artist, self.name)
@@ -172,17 +413,55 @@ class Album:
 
 
 class Track:
-    def __init__(self, path):
-        LOGGER.debug('Initialising track: %s', path)
-        self.path = path
-        trunk, self.type = os.path.splitext(path)
-        self.type = self.type[1:]   # Truncate leading .
+    __slots__ = ('path', 'type', 'tags', '_metadata', '_artist', '_album',
+                 '_track_number', '_filename')
+
+    def __init__(self, path, tags=None):
+        '''Initialise track for file at path.
 
+        `tags` is an optional subset of the file's metadata as returned
+        by `Track.read_tag_fields`. Any metadata not in it is read from
+        the file on first use.
+        '''
+        self.path = path
+        _trunk, self.type = os.path.splitext(path)
+        self.type = self.type[1:] or 'mp3'     # Truncate leading .
+        self.tags = tags or {}
+        self._metadata = None
+        # Memoized results of the getters below
+        self._artist = None
+        self._album = None
+        self._track_number = None
+        self._filename = None
+
+    @staticmethod
+    def read_tag_fields(path, fields=LOAD_FIELDS):
+        '''Read only the given metadata fields from the file at path.
+
+        Only the ID3 frames backing `fields` are parsed, the rest of
+        the tag is skipped. Fields not in the tag map to an empty list.
+        As with `Track.metadata`, untagged files get their name as title.
+        '''
+        known_frames = {}
+        for field in fields:
+            frame, frame_2_2 = ID3_FRAMES[field]
+            known_frames[frame] = Frames[frame]
+            known_frames[frame_2_2] = Frames_2_2[frame_2_2]
+        tag = EasyID3()
         try:
-            self.metadata = EasyID3(self.path)
+            tag.load(path, known_frames=known_frames)
         except ID3NoHeaderError:
-            self.metadata = {'title': os.path.basename(trunk)}
             LOGGER.exception('File %s has no ID3 tag', path)
+            tag = _untagged_metadata(path)
+        return {field: list(tag.get(field, [])) for field in fields}
+
+    @property
+    def metadata(self):
+        '''The file's full metadata, read on first access.'''
+
+        if self._metadata is None:
+            self._metadata = _read_metadata(self.path)
+        return self._metadata
 
     def get_path(self):
         '''Returns the file system path to the source file.'''
@@ -192,52 +471,66 @@ class Track:
     def get_type(self):
         '''Returns the audio file type (eg mp3).'''
 
-        return self.type or 'mp3'
+        return self.type
 
     def get_album(self):
-        return self._get_metadata('album') or 'Unknown Album'
+        if self._album is None:
+            # Interned as the same few names are shared by many tracks
+            album = self._get_metadata('album') or 'Unknown Album'
+            self._album = sys.intern(album)
+        return self._album
 
     def get_artist(self):
-        return (self._get_metadata('albumartist')
-                or self._get_metadata('artist')
-                or 'Unknown Artist')
+        if self._artist is None:
+            artist = (self._get_metadata('albumartist')
+                      or self._get_metadata('artist')
+                      or 'Unknown Artist')
+            self._artist = sys.intern(artist)
+        return self._artist
 
     def get_title(self):
         return self._get_metadata('title')
 
     def get_track_number(self):
-        track_number = self._get_metadata('tracknumber')
-        if track_number:
-            return re.sub(r'/\d+$', '', track_number) # We don't want total tracks counter
-        return  ''    # Would None make sense here?
+        if self._track_number is None:
+            track_number = self._get_metadata('tracknumber')
+            if track_number:
+                # We don't want total tracks counter
+                self._track_number = TRACK_TOTAL_REGEX.sub('', track_number)
+            else:
+                self._track_number = ''    # Would None make sense here?
+        return self._track_number
+
+    def get_filename(self):
+        '''Returns the name the track is exported under.
+
+        Name is of the form: Track Number. Track Name.type
+        '''
+        if self._filename is None:
+            track_no = self.get_track_number()
+            track_title = self.get_title()
+            if track_no:
+                filename = f'{track_no}. {track_title}.{self.type}'
+            else:
+                filename = f'{track_title}.{self.type}'
+            self._filename = normalise_filename(filename)
+        return self._filename
 
     def _get_metadata(self, name):
         '''Get the associated file's metadata (eg title, artist).'''
 
-        metadatum = self.metadata.get(name)
-        if isinstance(metadatum, (str, type(None))):
-            return metadatum
-        return ' & '.join(metadatum)
+        tags = self.tags if name in self.tags else self.metadata
+        values = tags.get(name)     # Always a list of str
+        return ' & '.join(values) if values else None
 
     def export(self, path):
         '''Save file to disk.'''
 
-        LOGGER.debug('Exporting %s to %s', self, path)
-        track_no = self.get_track_number()
-        track_title = self.get_title()
-        if track_no:
-            filename = '{0}. {1}.{2}'.format(track_no, track_title, self.get_type())
-        else:
-            filename = '{0}.{1}'.format(track_title, self.get_type())
-        export_path = os.path.join(path, normalise_filename(filename))
-        if not DRY_RUN:
-            if MOVE_EXPORT:
-                LOGGER.debug('Moving %s to %s', self.path, export_path)
-                shutil.move(self.path, export_path)
-            else:
-                LOGGER.debug('Copying %s to %s', self.path, export_path)
-                shutil.copy(self.path, export_path)
-        return os.path.join(path, filename)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('Exporting %s to %s', self, path)
+        export_path = os.path.join(path, self.get_filename())
+        export_file(self.path, export_path)
+        return export_path
 
     def __str__(self):
         return 'Track(/{0}/{1}/{2}. {3})'.format(
@@ -247,24 +540,29 @@ class Track:
 
 
 def main():
-    import sys
     import argparse
 
-    global DRY_RUN, LOGGER, MOVE_EXPORT
+    global DRY_RUN, EXPORT_WORKERS, LOGGER, MOVE_EXPORT
 
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--simulate', action='store_true',
                         help="Simulate run - don't actually export anything")
     parser.add_argument('--move', action='store_true',
                         help="Move files when exporting - don't copy them")
+    parser.add_argument('--parallel', type=int, default=1, metavar='N',
+                        help='Copy/move up to N files at once (helps with'
+                             ' slow or network targets)')
     parser.add_argument('--verbose', action='store_true',
                         help='Make a whole lot of noise')
     parser.add_argument('source', type=str, help='Library to be exported')
     parser.add_argument('target', type=str, help='Library to export to')
 
     args = parser.parse_args(sys.argv[1:])  # Don't want the script name
+    if args.parallel < 1:
+        parser.error('--parallel must be at least 1')
     DRY_RUN = args.simulate
     MOVE_EXPORT = args.move
+    EXPORT_WORKERS = args.parallel
 
     if DRY_RUN or args.verbose:
         stream_handler = logging.StreamHandler()